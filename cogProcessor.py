@@ -40,15 +40,17 @@ __date__ = '20240904'
 
 # Regular imports
 import os
+import errno
 import time 
 import numpy
 import shutil
 import random
-import subprocess
+import traceback
+import multiprocessing
 import netCDF4 as nc
 from osgeo import gdal
 from datetime import datetime
-from time import strftime, strptime
+from time import strftime
 
 
 def cogProcessor(cogCfgDict, logger = print):
@@ -56,11 +58,13 @@ def cogProcessor(cogCfgDict, logger = print):
 
     Creates the global COG image(s) from NetCDF input.
     For each band in the NetCDF input file that is also specified in the COG configuration
-    dictionary, a COG file will be created in a temporary location based on executing a set of GDAL commands:
-    * gdal_translate to convert a NetCDF band to a COG file
-    * gdaladdo to add the overviews
+    dictionary, a COG file will be created in a temporary location based on a chain of in-process
+    GDAL calls. Bands are processed in parallel, each in its own worker process:
+    * gdal.Translate to open a NetCDF band as a virtual image
+    * BuildOverviews to add the overviews to the virtual image, stored in an external overview file
+      kept in memory (/vsimem/) when it fits in the available RAM, in the temporary folder otherwise
     * gdal to add and/or alter file and band metadata
-    * gdal_translate to create the final optimized output file
+    * gdal.Translate to create the final COG file, reusing the overviews
     Once finished, a safe copy is done to move the COG file to the final output location
     
     Parameters
@@ -73,9 +77,11 @@ def cogProcessor(cogCfgDict, logger = print):
         * 'inFile': (str) Full path to NetCDF input file
         * 'hasTimeIndex': (bool) Flag to indicate product name contains a time index (e.g. RT0 or SE1)
         * 'overwriteExistingFiles': (bool) Overwrite existing output files
-        * 'compressionMethod': (str) compression method used, see gdal_translate for more information
+        * 'compressionMethod': (str) compression method used (e.g. ZSTD or DEFLATE), see the COG driver COMPRESS option for more information
+        * 'compressionLevel': (int) optional compression level, omit or None to use the GDAL default of the compression method
         * 'cogOverviews': (list of int) COG overview list, set None or empty list to skip overviews
         * 'blockSize': (int) blockSize of COG overviews
+        * 'gdalCacheMaxBytes': (int) optional GDAL block cache size in bytes, shared by all worker processes. Omit or None to keep the GDAL default of each process (5% of the physical RAM)
         * 'attributeConversion': (dict) NetCDF attributes to COG metadata conversion settings containing:
             * 'history': (str) string to be added to history, can contain the replacement variable <processDateISO> and <version>
             * 'listEnclosure': (str) unpack numeric list attributes into a string between the two elements. If an empty string is given, no enclosure is added.
@@ -89,7 +95,9 @@ def cogProcessor(cogCfgDict, logger = print):
         Instance to log to, defaults to print
     """
     logger('COG Processing kernel')
-    gdal.UseExceptions() # To prevent future warning
+    # Local copy with a set based lookup of the attributes to remove, leaving the caller's configuration untouched
+    conversionDict = dict(cogCfgDict['attributeConversion'])
+    conversionDict['removeAttributeLst'] = frozenset(conversionDict['removeAttributeLst'])
 
     # Create output folder
     logger(f' > Verifying output folder {cogCfgDict["outFolder"]}')
@@ -107,81 +115,88 @@ def cogProcessor(cogCfgDict, logger = print):
     else:
         logger('   > Existing')
 
-    logger(f' > Extracting attributes from input file {cogCfgDict["inFile"]}')
-    with nc.Dataset(cogCfgDict["inFile"], 'r') as src:
-        attributeDict = src.__dict__
-        bandLst = list(src.variables.keys())
-        # check if the file has all bands to be converted
-        for bandInfo in cogCfgDict['bandInfoList']:
-            if bandInfo['inBand'] in bandLst:
-                bandInfo['attributes'] = src.variables[bandInfo['inBand']].__dict__
-            else:
-                raise ValueError(f'{bandInfo["inBand"]} not found in {cogCfgDict["inFile"]}:{bandLst}')
-
-    tempFileList = []
-    logger(f' > Creating {len(cogCfgDict["bandInfoList"])} COG file(s)')
-    for index, bandInfo in enumerate(cogCfgDict['bandInfoList']):
-        srcPath = f'NETCDF:"{cogCfgDict["inFile"]}":{bandInfo["inBand"]}'
+    # List the existing output files once instead of testing each COG file
+    existingFileSet = set()
+    if not cogCfgDict['overwriteExistingFiles']:
+        with os.scandir(cogCfgDict['outFolder']) as entries:
+            existingFileSet = {entry.name for entry in entries if entry.is_file()}
 
+    bandInfoList = cogCfgDict['bandInfoList']
+    logger(f' > Verifying {len(bandInfoList)} COG file(s)')
+    todoList = []
+    for index, bandInfo in enumerate(bandInfoList):
         cogFile = createCogFileName(os.path.basename(cogCfgDict['inFile']),
                                     bandInfo['inBand'],
                                     bandInfo['outBand'], 
                                     cogCfgDict['hasTimeIndex'])
-
-        cogPath = os.path.join(cogCfgDict["outFolder"], cogFile)
-        tempBasePath = os.path.join(cogCfgDict["tmpFolder"], os.path.splitext(cogFile)[0])
-        logger(f'   > {index+1:>2}/{len(cogCfgDict["bandInfoList"])}: {cogFile}')
-        if not cogCfgDict['overwriteExistingFiles'] and os.path.isfile(cogPath):
+        if cogFile in existingFileSet:
+            logger(f'   > {index+1:>2}/{len(bandInfoList)}: {cogFile}')
             logger('     > Skipped: file already exists')
-            continue
-        logger('     > Creating GeoTiff base image')
-        tiffFile = tempBasePath + '_base.tiff'
-        tempFileList.append(tiffFile)
-
-        cmd = f'gdal_translate -of GTIFF {srcPath} {tiffFile}'
-
-        logger(f'     > execute command: {cmd}')
-        _runShellCmd(cmd, logger)
-
-        if cogCfgDict["cogOverviews"]:
-            logger('     > Adding overviews')
-            cmd = f'gdaladdo -clean  {tiffFile}'
-            logger(f'     > execute command: {cmd}')
-            _runShellCmd(cmd, logger)
-            overviewStr = map(str, cogCfgDict["cogOverviews"])
-            overviewStr = ' '.join(overviewStr)
-            cmd = f'gdaladdo -ro --config GDAL_TIFF_OVR_BLOCKSIZE {cogCfgDict["blockSize"]} --config COMPRESS_OVERVIEW {cogCfgDict["compressionMethod"]} -r {bandInfo["resampleMethod"]} {tiffFile} {overviewStr}'
-            logger(f'     > execute command: {cmd}')
-            _runShellCmd(cmd, logger)
-            tempFileList.append(tiffFile+'.ovr')
-
-        logger('     > Converting attributes to metadata')
-        metadataDict = _convertFileAttributes(attributeDict, cogCfgDict['attributeConversion'], cogFile)
-        bandMetadataDict = _convertBandAttributes(bandInfo['attributes'], cogCfgDict['attributeConversion'])
-
-        logger('     > Setting metadata')
-        ds = gdal.Open(tiffFile, gdal.GA_Update)
-        ds.SetMetadata(metadataDict)
-        ds.GetRasterBand(1).SetMetadata(bandMetadataDict)
-        ds.GetRasterBand(1).SetDescription(bandInfo['description'])
-        ds = None
+        else:
+            todoList.append((index, bandInfo, cogFile))
+    if not todoList:
+        logger(' > Nothing to do: all COG files already exist')
+        return
 
-        logger('     > Creating final COG')
-        cogTmpFile = tempBasePath + '.tmp.tiff'
-        cmd =  f'gdal_translate -of COG '
-        cmd += f'-co COMPRESS={cogCfgDict["compressionMethod"]} '
-        cmd += f'-co PREDICTOR=YES '
-        cmd += f'--config GDAL_TIFF_OVR_BLOCKSIZE {cogCfgDict["blockSize"]} '
-        cmd += f'{tiffFile} {cogTmpFile}'
-        logger(f'     > execute command: {cmd}')
-        _runShellCmd(cmd, logger)
-
-        logger(f'     > Moving to final location: {cogPath}')
-        _safeMove(cogTmpFile, cogPath)
-        
-    logger(f' > Removing temp files from {cogCfgDict["tmpFolder"]}')
-    for tempFile in tempFileList:
-        os.remove(tempFile)
+    logger(f' > Extracting attributes from input file {cogCfgDict["inFile"]}')
+    with nc.Dataset(cogCfgDict["inFile"], 'r') as src:
+        attributeDict = dict(src.__dict__)
+        variables = src.variables
+        # check if the file has all configured bands before reading any band attributes
+        missingBandSet = {bandInfo['inBand'] for bandInfo in bandInfoList} - variables.keys()
+        if missingBandSet:
+            raise ValueError(f'{", ".join(sorted(missingBandSet))} not found in {cogCfgDict["inFile"]}:{list(variables)}')
+        # Plain dict copies, detached from the NetCDF file handle
+        bandAttributeDict = {bandInfo['inBand']: dict(variables[bandInfo['inBand']].__dict__)
+                             for _index, bandInfo, _cogFile in todoList}
+
+    # File attributes are shared by all bands, only the identifier depends on the COG filename
+    logger(' > Converting attributes to metadata')
+    baseMetadataDict = _convertFileAttributes(attributeDict, conversionDict)
+
+    cpuCount = os.cpu_count() or 1
+    processes = min(len(todoList), cpuCount)
+    numThreads = max(1, cpuCount // processes)
+    cacheMaxBytes = None
+    if cogCfgDict.get('gdalCacheMaxBytes') is not None:
+        cacheMaxBytes = cogCfgDict['gdalCacheMaxBytes'] // processes
+    # Intermediate overviews are kept in memory when they fit in half of the available RAM
+    memoryMaxBytes = _availableMemory() // (2 * processes)
+
+    jobList = []
+    for index, bandInfo, cogFile in todoList:
+        metadataDict = dict(baseMetadataDict)
+        if 'identifier' in metadataDict:
+            metadataDict['identifier'] = _cogIdentifier(attributeDict['parent_identifier'], cogFile)
+        # Only the settings used by the worker, to keep the pickled job small
+        jobList.append({
+            'index': index,
+            'bandCount': len(bandInfoList),
+            'srcPath': f'NETCDF:"{cogCfgDict["inFile"]}":{bandInfo["inBand"]}',
+            'cogFile': cogFile,
+            'outFolder': cogCfgDict['outFolder'],
+            'tmpFolder': cogCfgDict['tmpFolder'],
+            'metadata': metadataDict,
+            'bandMetadata': _convertBandAttributes(bandAttributeDict[bandInfo['inBand']], conversionDict),
+            'description': bandInfo['description'],
+            'resampleMethod': bandInfo['resampleMethod'],
+            'cogOverviews': cogCfgDict['cogOverviews'],
+            'blockSize': cogCfgDict['blockSize'],
+            'compressionMethod': cogCfgDict['compressionMethod'],
+            'compressionLevel': cogCfgDict.get('compressionLevel'),
+            'memoryMaxBytes': memoryMaxBytes,
+            'numThreads': numThreads,
+            })
+
+    logger(f' > Creating {len(jobList)} COG file(s) using {processes} process(es)')
+    with multiprocessing.Pool(processes=processes, initializer=_initWorker,
+                              initargs=(numThreads, cacheMaxBytes)) as pool:
+        # Workers return their log messages, so all logging is done by the caller's logger in this process
+        for logLst, errorMessage in pool.imap_unordered(_processOneBand, jobList):
+            for message in logLst:
+                logger(message)
+            if errorMessage is not None:
+                raise RuntimeError(errorMessage)
 
 
 def createCogFileName(inFile, inBand, outBand = None, hasTimeIndex = False):
@@ -219,6 +234,172 @@ def createCogFileName(inFile, inBand, outBand = None, hasTimeIndex = False):
     return cogFile
 
 
+def _initWorker(numThreads, cacheMaxBytes):
+    """ Initialise GDAL in a COG worker process
+
+    Parameters
+    ----------
+    numThreads : int
+        Number of threads GDAL may use for overviews and compression within this process
+    cacheMaxBytes : int
+        Size of the GDAL block cache of this process in bytes, None to keep the GDAL default
+
+    Returns
+    -------
+    None
+    """
+    gdal.UseExceptions() # To prevent future warning
+    gdal.SetConfigOption('GDAL_NUM_THREADS', str(numThreads))
+    if cacheMaxBytes is not None:
+        gdal.SetCacheMax(cacheMaxBytes)
+
+
+def _processOneBand(jobDict):
+    """ Create the COG file of a single NetCDF band
+
+    Runs in a worker process. Log messages are collected and returned instead
+    of being logged, so the caller's logger does not have to be picklable.
+
+    Parameters
+    ----------
+    jobDict : dict
+        job dictionary which should contain the following keys:
+        * 'index': (int) Index of the band in the band info list, used for logging
+        * 'bandCount': (int) Number of bands in the band info list, used for logging
+        * 'srcPath': (str) GDAL path of the NetCDF band
+        * 'cogFile': (str) COG filename
+        * 'outFolder', 'tmpFolder': (str) see cogProcessor
+        * 'metadata': (dict) COG file metadata
+        * 'bandMetadata': (dict) COG band metadata
+        * 'description', 'resampleMethod': (str) see bandInfoList of cogProcessor
+        * 'cogOverviews', 'blockSize', 'compressionMethod', 'compressionLevel': see cogProcessor
+        * 'memoryMaxBytes': (int) Maximum size of the intermediate overviews to keep them in memory
+        * 'numThreads': (int) Number of compression threads of the COG driver
+
+    Returns
+    -------
+    list of str
+        Log messages of the band
+    str or None
+        Error message if the COG file could not be created
+    """
+    logLst = []
+    try:
+        _createCog(jobDict, logLst.append)
+    except Exception as e:
+        # Return the error with the messages logged so far, which would be lost when raising in the worker
+        logLst += traceback.format_exc().splitlines()
+        return logLst, f'Failed to create {jobDict["cogFile"]} from {jobDict["srcPath"]}: {e}'
+    return logLst, None
+
+
+def _createCog(jobDict, logger):
+    """ Create the COG file of a single NetCDF band
+
+    Parameters
+    ----------
+    jobDict : dict
+        job dictionary, see _processOneBand
+    logger : function
+        logging function
+    """
+    cogFile = jobDict['cogFile']
+    cogPath = os.path.join(jobDict["outFolder"], cogFile)
+    tempBasePath = os.path.join(jobDict["tmpFolder"], os.path.splitext(cogFile)[0])
+    logger(f'   > {jobDict["index"]+1:>2}/{jobDict["bandCount"]}: {cogFile}')
+    cogTmpFile = tempBasePath + '.tmp.tiff'
+    tempFileList = []
+    srcDs = None
+    ds = None
+    cogDs = None
+    try:
+        logger('     > Opening NetCDF band as virtual image')
+        srcDs = gdal.Open(jobDict['srcPath'])
+        if jobDict["cogOverviews"] and _overviewBytes(srcDs, jobDict["cogOverviews"]) > jobDict['memoryMaxBytes']:
+            vrtFile = tempBasePath + '.vrt'
+        else:
+            vrtFile = f'/vsimem/{os.path.basename(tempBasePath)}.vrt'
+        tempFileList += [vrtFile, vrtFile + '.ovr']
+        ds = gdal.Translate(vrtFile, srcDs, format='VRT')
+
+        if jobDict["cogOverviews"]:
+            logger(f'     > Adding overviews {jobDict["cogOverviews"]} in {os.path.dirname(vrtFile)}')
+            # External overviews (.vrt.ovr) of the VRT, in memory or in the temporary working folder
+            with gdal.config_options({'GDAL_TIFF_OVR_BLOCKSIZE': str(jobDict["blockSize"]),
+                                      'COMPRESS_OVERVIEW': jobDict["compressionMethod"]}):
+                ds.BuildOverviews(jobDict["resampleMethod"], jobDict["cogOverviews"])
+
+        logger('     > Setting metadata')
+        ds.SetMetadata(jobDict['metadata'])
+        ds.GetRasterBand(1).SetMetadata(jobDict['bandMetadata'])
+        ds.GetRasterBand(1).SetDescription(jobDict['description'])
+
+        logger('     > Creating final COG')
+        # PREDICTOR=YES selects the horizontal predictor for integer and the floating point predictor for float bands
+        creationOptions = [f'COMPRESS={jobDict["compressionMethod"]}',
+                           'PREDICTOR=YES',
+                           'SPARSE_OK=YES',
+                           f'NUM_THREADS={jobDict["numThreads"]}']
+        if jobDict['compressionLevel'] is not None:
+            creationOptions += [f'LEVEL={jobDict["compressionLevel"]}']
+        if jobDict["cogOverviews"]:
+            # Reuse the overviews of the VRT
+            creationOptions += ['OVERVIEWS=AUTO']
+        else:
+            creationOptions += ['OVERVIEWS=NONE']
+        with gdal.config_options({'GDAL_TIFF_OVR_BLOCKSIZE': str(jobDict["blockSize"])}):
+            cogDs = gdal.Translate(cogTmpFile, ds, format='COG', creationOptions=creationOptions)
+    except:
+        # Do not leave a partially written COG behind
+        tempFileList.append(cogTmpFile)
+        raise
+    finally:
+        # Close the datasets before removing their files
+        cogDs = None
+        ds = None
+        srcDs = None
+        for tempFile in tempFileList:
+            if gdal.VSIStatL(tempFile) is not None:
+                gdal.Unlink(tempFile)
+
+    logger(f'     > Moving to final location: {cogPath}')
+    _safeMove(cogTmpFile, cogPath)
+
+
+def _overviewBytes(ds, overviewLst):
+    """ Estimate the uncompressed size of the overviews of a dataset
+
+    Parameters
+    ----------
+    ds : gdal.Dataset
+        Dataset to add the overviews to
+    overviewLst : list of int
+        Overview factors
+
+    Returns
+    -------
+    int
+        Size of all overview levels in bytes
+    """
+    pixelBytes = ds.RasterCount * gdal.GetDataTypeSize(ds.GetRasterBand(1).DataType) // 8
+    return sum(-(-ds.RasterXSize // factor) * -(-ds.RasterYSize // factor) * pixelBytes
+               for factor in overviewLst)
+
+
+def _availableMemory():
+    """ Get the available physical memory of the system
+
+    Returns
+    -------
+    int
+        Available memory in bytes, 0 if it can not be determined on this platform
+    """
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return 0
+
+
 def _safeMakeDirs(directory, mode=0o777, attempts = 3):
     """ create a directory on the cluster, safeguarding multiple servers doing the same
     
@@ -229,22 +410,27 @@ def _safeMakeDirs(directory, mode=0o777, attempts = 3):
     mode : int
         Integer value representing mode of the newly created directory
     attempts : int
-        Number of attempts before raising the latest exception
+        Number of attempts before raising the latest exception. Attempts are
+        separated by an exponential backoff starting at 50 ms
     
     Returns
     -------
     None
     """
+    delay = 0.05
     while True:
         try:
             os.makedirs(directory, mode=mode, exist_ok=True)
             break
         except:
+            # Another server may have created the directory in the meantime
+            if os.path.isdir(directory):
+                break
             if attempts == 1:
                 raise
-            time.sleep(random.uniform(0.1,5.0))
-            if os.path.isdir(directory):
-                 break
+            # Exponential backoff, randomised to avoid servers retrying simultaneously
+            time.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(2 * delay, 1.0)
             attempts -= 1
 
 
@@ -262,13 +448,10 @@ def _today(outFormat='%Y-%m-%d'):
         date
 
     """
-    timestampFormat = '%Y-%m-%d %H:%M:%S.%f'
-    timestamp = datetime.now().strftime(timestampFormat)
-    date=strptime(timestamp,timestampFormat)
-    return strftime(outFormat,date)
+    return datetime.now().strftime(outFormat)
 
 
-def _convertFileAttributes(attributeDict, conversionDict, filename):
+def _convertFileAttributes(attributeDict, conversionDict, filename = None):
     """ Convert CF-1.6 NetCDF file attributes to COG metadata
 
     Parameters
@@ -278,31 +461,46 @@ def _convertFileAttributes(attributeDict, conversionDict, filename):
     conversionDict : dict
         Conversion settings
     filename : str
-        COG filename
+        COG filename, used to create the identifier. When None, the identifier
+        is copied unaltered, see _cogIdentifier to set it afterwards. Defaults to None
     
     Returns
     -------
     Dict:
         COG metadata
     """
-    metadata = {}
-    for key, value in attributeDict.items():
-        if key in conversionDict['removeAttributeLst']:
-            continue
-        if key == 'history':
-            history = conversionDict['history']
-            history = history.replace('<processDateISO>', _today())
-            history = history.replace('<version>', __version__)
-            metadata[key] = value + f'\n{history}'
-        elif key == 'identifier':
-            id = os.path.splitext(filename)[0]
-            id = id.replace('c_gls_', '')
-            metadata[key] = f'{attributeDict["parent_identifier"]}:{id}'
-        else:
-            metadata[key] = value
+    metadata = {key: value for key, value in attributeDict.items()
+                if key not in conversionDict['removeAttributeLst']}
+    if 'history' in metadata:
+        history = conversionDict['history']
+        history = history.replace('<processDateISO>', _today())
+        history = history.replace('<version>', __version__)
+        metadata['history'] += f'\n{history}'
+    if 'identifier' in metadata and filename:
+        metadata['identifier'] = _cogIdentifier(attributeDict['parent_identifier'], filename)
     return metadata
 
 
+def _cogIdentifier(parentIdentifier, filename):
+    """ Create the COG identifier metadata value
+
+    Parameters
+    ----------
+    parentIdentifier : str
+        NetCDF parent_identifier attribute
+    filename : str
+        COG filename
+
+    Returns
+    -------
+    str
+        COG identifier
+    """
+    id = os.path.splitext(filename)[0]
+    id = id.replace('c_gls_', '')
+    return f'{parentIdentifier}:{id}'
+
+
 def _convertBandAttributes(attributeDict, conversionDict):
     """ Convert CF-1.6 NetCDF band attributes to COG metadata
 
@@ -322,8 +520,8 @@ def _convertBandAttributes(attributeDict, conversionDict):
     for key, value in attributeDict.items():
         if key in conversionDict['removeAttributeLst']:
             continue
-        elif type(value) == numpy.ndarray:
-            lstStr = conversionDict['listSeparator'].join(map(str, value))
+        elif isinstance(value, numpy.ndarray):
+            lstStr = conversionDict['listSeparator'].join(value.astype(str).tolist())
             if len(conversionDict['listEnclosure']) == 2:
                 lstStr = f'{conversionDict["listEnclosure"][0]}{lstStr}{conversionDict["listEnclosure"][1]}'
             elif len(conversionDict['listEnclosure']) != 0:
@@ -334,38 +532,6 @@ def _convertBandAttributes(attributeDict, conversionDict):
     return metadata
 
 
-def _runShellCmd(cmd, logger):
-    """ run a command (cmd) with subprocess and put ouput in logger
-    
-    Parameters
-    ----------
-    cmd : str
-    logger : object
-        Instance to log to
-    
-    Returns
-    -------
-    None
-    """
-    try:
-        output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        logger('     Failed!')
-        logger('     Process output:')
-        logger('     +-')
-        for line in e.output.splitlines():
-            logger('     | ' + line.decode('utf-8'))
-        logger('     +-')
-        raise e
-
-    logger('     Done.')
-    logger('     Process output:')
-    logger('     +-')
-    for line in output.splitlines():
-        logger('     | ' + line.decode('utf-8'))
-    logger('     +-')
-
-
 def _unpackNetCDFProductName(productname, hasTimeIndex):
     """ Unpack CGLOPS NetCDF product name into dictionary of elements
     <project>_<product>_<productDate>_<ROI>_<SENSOR>_<VERSION>.nc
@@ -437,10 +603,11 @@ def _packCOGProductName(prodElements):
 def _safeMove(src, dst, mod = 0o644):
     """ Do a 'save' move from source (src) to destination (dst)
 
-    A 'save' move will first copy a temporary file to the destination and then
-    rename the temporary file to the destination file. If files already exists,
-    they will be removed before the copy/rename action. In all is succesfull, the src
-    file will be removed.
+    When source and destination are on the same file system, the source is
+    renamed to the destination, which replaces an existing destination file
+    atomically. Otherwise a 'save' move will first copy a temporary file to the
+    destination and then replace the destination file by the temporary file in a
+    single atomic rename. If all is succesfull, the src file will be removed.
 
     Parameters
     ----------
@@ -451,14 +618,18 @@ def _safeMove(src, dst, mod = 0o644):
     mod: str
         File permisions (octal), defaults to owner R/W, group R, others R
     """
+    try:
+        os.chmod(src, mod)
+        os.rename(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
     tmpFile = dst + '.temp'
-    if os.path.isfile(tmpFile):
-        os.remove(tmpFile)
-    shutil.copy(src, tmpFile)
-    if os.path.isfile(dst):
-        os.remove(dst)
-    os.rename(tmpFile, dst)
-    os.chmod(dst, mod)
+    shutil.copyfile(src, tmpFile)
+    os.chmod(tmpFile, mod)
+    os.replace(tmpFile, dst)
     os.remove(src)
 
 